@@ -6,7 +6,7 @@ from domain.gps import Gps
 from domain.parking import Parking
 
 
-@dataclass
+@dataclass(slots=True)
 class AggregatedData:
     accelerometer: Accelerometer
     gps: Gps
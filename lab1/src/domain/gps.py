@@ -1,7 +1,7 @@
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class Gps:
     longitude: float
     latitude: float
\ No newline at end of file
@@ -2,7 +2,7 @@ from domain.gps import Gps
 from dataclasses import dataclass
 
 
-@dataclass
+@dataclass(slots=True)
 class Parking:
     empty_count: int
     gps: Gps
\ No newline at end of file
@@ -1,13 +1,44 @@
-from csv import reader
+from collections import deque
 from datetime import datetime
+from typing import TextIO
 
 import sys
+import numpy as np
+import pandas as pd
 import config
 from domain.accelerometer import Accelerometer
 from domain.gps import Gps
 from domain.parking import Parking
 from domain.aggregated_data import AggregatedData
 
+# Rows parsed from a CSV file at once
+CHUNK_SIZE = 10_000
+# Looked up once instead of on every read
+USER_ID = config.USER_ID
+
+
+class CsvChunkReader:
+    """Читає CSV файл частинами та повертає рядки по одному"""
+
+    def __init__(self, file: TextIO, dtype: dict) -> None:
+        # round_trip parses floats exactly like float(), the default parser may be off by one ULP
+        self._chunks = pd.read_csv(file, dtype=dtype, chunksize=CHUNK_SIZE, engine="c",
+                                   float_precision="round_trip")
+        self._columns = []
+        self._length = 0
+        self._i = 0
+
+    def next_row(self) -> tuple:
+        """Повертає наступний рядок, StopIteration в кінці файлу"""
+        if self._i >= self._length:
+            chunk = next(self._chunks)
+            self._columns = [chunk[column].to_numpy() for column in chunk.columns]
+            self._length = len(chunk)
+            self._i = 0
+        i = self._i
+        self._i = i + 1
+        return tuple(column[i] for column in self._columns)
+
 
 class FileDatasource:
 
@@ -23,50 +54,73 @@ class FileDatasource:
         self.accelerometer_data = None
         self.gps_data = None
         self.parking_data = None
-        pass
+        self._acc_file = None
+        self._gps_file = None
+        self._park_file = None
+        # Released AggregatedData objects, reused by read
+        self._pool = deque()
 
     def read(self):
         """Метод повертає дані отримані з датчиків"""
         try:
-            accelerometer_data_row = next(self.accelerometer_data)
-            gps_data_row = next(self.gps_data)
-            parking_data_row = next(self.parking_data)
+            x, y, z = self.accelerometer_data.next_row()
+            longitude, latitude = self.gps_data.next_row()
+            empty_count, parking_longitude, parking_latitude = self.parking_data.next_row()
         except StopIteration:
             sys.exit()
 
+        if self._pool:
+            data = self._pool.pop()
+            accelerometer = data.accelerometer
+            accelerometer.x, accelerometer.y, accelerometer.z = x, y, z
+            data.gps.longitude, data.gps.latitude = longitude, latitude
+            data.parking.empty_count = empty_count
+            data.parking.gps.longitude, data.parking.gps.latitude = parking_longitude, parking_latitude
+            data.timestamp = datetime.now()
+            return data
+
         return AggregatedData(
-            Accelerometer(int(accelerometer_data_row[0]), int(accelerometer_data_row[1]), int(accelerometer_data_row[2])),
-            Gps(float(gps_data_row[0]), float(gps_data_row[1])),
-            Parking(int(parking_data_row[0]), Gps(float(parking_data_row[1]), float(parking_data_row[2]))),
+            Accelerometer(x, y, z),
+            Gps(longitude, latitude),
+            Parking(empty_count, Gps(parking_longitude, parking_latitude)),
             datetime.now(),
-            config.USER_ID
+            USER_ID
         )
 
 
+    def release(self, data: AggregatedData):
+        """Метод повертає дані, отримані з read, для повторного використання"""
+        self._pool.append(data)
+
+
     def startReading(self):
         """Метод повинен викликатись перед початком читання даних"""
         try:
-            accelerometer_file = open(self.accelerometer_filename)
-            self.accelerometer_data = reader(accelerometer_file)
-            next(self.accelerometer_data)
+            self._acc_file = open(self.accelerometer_filename)
+            self.accelerometer_data = CsvChunkReader(
+                self._acc_file, {"x": np.int32, "y": np.int32, "z": np.int32})
 
-            gps_file = open(self.gps_filename)
-            self.gps_data = reader(gps_file)
-            next(self.gps_data)
+            self._gps_file = open(self.gps_filename)
+            self.gps_data = CsvChunkReader(
+                self._gps_file, {"longitude": np.float64, "latitude": np.float64})
 
-            parking_file = open(self.parking_filename)
-            self.parking_data = reader(parking_file)
-            next(self.parking_data)
+            self._park_file = open(self.parking_filename)
+            self.parking_data = CsvChunkReader(
+                self._park_file,
+                {"empty_count": np.int32, "longitude": np.float64, "latitude": np.float64})
         except FileNotFoundError as e:
             print(f"File not found: {e.filename}")
+            self.stopReading()
             sys.exit()
 
 
     def stopReading(self):
         """Метод повинен викликатись для закінчення читання даних"""
-        if self.accelerometer_data:
-            self.accelerometer_data.close()
-        if self.gps_data:
-            self.gps_data.close()
-        if self.parking_data:
-            self.parking_data.close()
\ No newline at end of file
+        if self._acc_file:
+            self._acc_file.close()
+        if self._gps_file:
+            self._gps_file.close()
+        if self._park_file:
+            self._park_file.close()
+        self._acc_file = self._gps_file = self._park_file = None
+        self.accelerometer_data = self.gps_data = self.parking_data = None
@@ -29,6 +29,7 @@ def publish(client, topic, datasource, delay):
         time.sleep(delay)
         data = datasource.read()
         msg = AggregatedDataSchema().dumps(data)
+        datasource.release(data)
         result = client.publish(topic, msg)
         # result: [0, 1]
         status = result[0]
@@ -1,9 +1,15 @@
-import json
-from datetime import datetime
-from typing import Set, List
-
-from fastapi import FastAPI, WebSocket, HTTPException, WebSocketDisconnect
-from pydantic import BaseModel, field_validator
+import asyncio
+import io
+import math
+from datetime import datetime, timezone
+from typing import Annotated, Dict, List
+
+import ciso8601
+import orjson
+from fastapi import FastAPI, WebSocket, HTTPException, WebSocketDisconnect, Depends, Body, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel, BeforeValidator, TypeAdapter, field_validator
 from sqlalchemy import (
     create_engine,
     MetaData,
@@ -14,7 +20,8 @@ from sqlalchemy import (
     Float,
     DateTime,
 )
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.sql import select, insert, update, delete
 
 from config import (
@@ -33,12 +40,59 @@ COLUMN_LATITUDE = "latitude"
 COLUMN_LONGITUDE = "longitude"
 COLUMN_TIMESTAMP = "timestamp"
 
-app = FastAPI()
-# WebSocket subscriptions
-subscriptions: Set[WebSocket] = set()
+# Max rows per INSERT statement when storing processed agent data
+BATCH_SIZE = 1000
+# Connections per engine pool; the sync and async engines together open at most
+# 2 * (POOL_SIZE + POOL_MAX_OVERFLOW) = 60, within Postgres' default max_connections=100
+POOL_SIZE = 10
+POOL_MAX_OVERFLOW = 20
+# Uploads with more rows than this are stored with COPY instead of INSERT
+COPY_THRESHOLD = 5_000
+# Rows fetched from the server-side cursor at once when exporting
+EXPORT_BUFFER_SIZE = 1000
+# Largest page the list endpoint returns, bigger exports go through /export/
+MAX_PAGE_SIZE = 1000
+# Websocket message for one processed agent data row; road_state is passed
+# already JSON-encoded, finite floats are formatted with their repr
+PROCESSED_AGENT_DATA_TEMPLATE = (
+    '{"road_state":%s,"x":%s,"y":%s,"z":%s,"latitude":%s,"longitude":%s,"timestamp":"%s"}'
+)
+# Messages queued per websocket subscriber before new ones are dropped
+SUBSCRIBER_QUEUE_SIZE = 256
+
+app = FastAPI(default_response_class=ORJSONResponse)
+# WebSocket subscriptions and their outgoing message queues
+subscriptions: Dict[WebSocket, asyncio.Queue] = {}
 
 DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-engine = create_engine(DATABASE_URL)
+# values_plus_batch lets psycopg2 collapse executemany() into multi-row
+# INSERT ... VALUES (...), (...) statements, one round-trip per page
+engine = create_engine(
+    DATABASE_URL,
+    executemany_mode="values_plus_batch",
+    insertmanyvalues_page_size=1000,
+    executemany_batch_page_size=500,
+    # Pool sized for concurrent requests; LIFO keeps the most recently used
+    # connections busy and lets the rest idle out
+    pool_size=POOL_SIZE,
+    max_overflow=POOL_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_use_lifo=True,
+)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine for the read endpoints, served on the event loop by asyncpg
+ASYNC_DATABASE_URL = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+async_engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    pool_size=POOL_SIZE,
+    max_overflow=POOL_MAX_OVERFLOW,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    pool_use_lifo=True,
+)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 metadata = MetaData()
 # Define the ProcessedAgentData table
 processed_agent_data = Table(
@@ -53,6 +107,18 @@ processed_agent_data = Table(
     Column(COLUMN_LONGITUDE, Float),
     Column(COLUMN_TIMESTAMP, DateTime),
 )
+# Built once so every upload reuses the same statement and its compiled form
+INSERT_STMT = insert(processed_agent_data)
+
+
+def parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value
+    try:
+        return ciso8601.parse_datetime(value)
+    except (TypeError, ValueError):
+        raise ValueError(
+            "Invalid timestamp format. Expected ISO 8601 format (YYYY-MM-DDTHH:MM:SSZ).")
 
 
 class AccelerometerData(BaseModel):
@@ -71,16 +137,10 @@ class AgentData(BaseModel):
     gps: GpsData
     timestamp: datetime
 
-    @classmethod
     @field_validator('timestamp', mode='before')
+    @classmethod
     def check_timestamp(cls, value):
-        if isinstance(value, datetime):
-            return value
-        try:
-            return datetime.fromisoformat(value)
-        except (TypeError, ValueError):
-            raise ValueError(
-                "Invalid timestamp format. Expected ISO 8601 format (YYYY-MM-DDTHH:MM:SSZ).")
+        return parse_timestamp(value)
 
 
 class ProcessedAgentData(BaseModel):
@@ -100,39 +160,165 @@ class ProcessedAgentDataInDB(BaseModel):
     timestamp: datetime
 
 
+# Validators for the fields of a partial update, built once
+str_adapter = TypeAdapter(str)
+float_adapter = TypeAdapter(float)
+# Same rule as AgentData.timestamp
+timestamp_adapter = TypeAdapter(Annotated[datetime, BeforeValidator(parse_timestamp)])
+
+
+def _get_object(data: dict, key: str) -> dict:
+    value = data.get(key, {})
+    if not isinstance(value, dict):
+        raise ValueError(f"{key} must be an object")
+    return value
+
+
+def get_update_values(data: dict) -> dict:
+    """Validate only the fields present in an update body and map them to columns"""
+    values = {}
+    if "road_state" in data:
+        values[COLUMN_ROAD_STATE] = str_adapter.validate_python(data["road_state"])
+
+    agent_data = _get_object(data, "agent_data")
+    accelerometer = _get_object(agent_data, "accelerometer")
+    gps = _get_object(agent_data, "gps")
+    for source, field, column in (
+        (accelerometer, "x", COLUMN_X),
+        (accelerometer, "y", COLUMN_Y),
+        (accelerometer, "z", COLUMN_Z),
+        (gps, "latitude", COLUMN_LATITUDE),
+        (gps, "longitude", COLUMN_LONGITUDE),
+    ):
+        if field in source:
+            values[column] = float_adapter.validate_python(source[field])
+    if "timestamp" in agent_data:
+        values[COLUMN_TIMESTAMP] = to_db_timestamp(timestamp_adapter.validate_python(agent_data["timestamp"]))
+    return values
+
+
 def get_db():
-    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = SessionLocal()
     try:
-        return db
+        yield db
     finally:
         db.close()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def to_db_timestamp(value: datetime) -> datetime:
+    # The column has no time zone: store aware timestamps as naive UTC so
+    # INSERT and COPY write the same value
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _copy_value(value) -> str:
+    # Escape the characters that are special in COPY text format
+    return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+            .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def copy_processed_agent_data(db: Session, rows: List[dict]):
+    """Store rows with COPY FROM STDIN inside the session transaction"""
+    columns = (COLUMN_ROAD_STATE, COLUMN_X, COLUMN_Y, COLUMN_Z, COLUMN_LATITUDE, COLUMN_LONGITUDE,
+               COLUMN_TIMESTAMP)
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(row[column]) for column in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    cursor = db.connection().connection.cursor()
+    try:
+        cursor.copy_from(buffer, processed_agent_data.name, columns=columns)
+    finally:
+        cursor.close()
+
+
+def store_processed_agent_data(db: Session, rows: List[dict]):
+    """Store rows with COPY for large uploads and batched INSERTs otherwise"""
+    if len(rows) > COPY_THRESHOLD:
+        copy_processed_agent_data(db, rows)
+    else:
+        # One transaction, one INSERT per batch of rows
+        for i in range(0, len(rows), BATCH_SIZE):
+            db.execute(INSERT_STMT, rows[i:i + BATCH_SIZE])
+    db.commit()
+
+
+async def _sender(websocket: WebSocket, queue: asyncio.Queue):
+    # Deliver queued messages to one subscriber
+    try:
+        while True:
+            message = await queue.get()
+            await websocket.send_text(message)
+    except Exception:
+        # Connection is gone, stop queueing messages for it
+        subscriptions.pop(websocket, None)
+
+
 # FastAPI WebSocket endpoint
 @app.websocket("/ws/")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
-    subscriptions.add(websocket)
+    queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    sender = asyncio.create_task(_sender(websocket, queue))
+    subscriptions[websocket] = queue
     try:
         while True:
             await websocket.receive_text()
     except WebSocketDisconnect:
-        subscriptions.remove(websocket)
+        pass
+    finally:
+        subscriptions.pop(websocket, None)
+        sender.cancel()
+
+
+def _processed_agent_data_json(row: dict) -> str:
+    x, y, z = row[COLUMN_X], row[COLUMN_Y], row[COLUMN_Z]
+    latitude, longitude = row[COLUMN_LATITUDE], row[COLUMN_LONGITUDE]
+    if not all(map(math.isfinite, (x, y, z, latitude, longitude))):
+        # repr of nan/inf is not valid JSON, orjson writes them as null
+        return orjson.dumps(row).decode()
+    return PROCESSED_AGENT_DATA_TEMPLATE % (
+        orjson.dumps(row[COLUMN_ROAD_STATE]).decode(),
+        x,
+        y,
+        z,
+        latitude,
+        longitude,
+        row[COLUMN_TIMESTAMP].isoformat(),
+    )
+
+
+def processed_agent_data_message(rows: List[dict]) -> str:
+    """Build the websocket message for stored rows from the fixed template"""
+    return "[" + ",".join(_processed_agent_data_json(row) for row in rows) + "]"
 
 
 # Function to send data to subscribed users
-async def send_data_to_subscribers(data):
-    for websocket in subscriptions:
-        await websocket.send_json(json.dumps(data))
+def broadcast(payload: str):
+    # Queue the message for every subscriber without waiting for the sends
+    for queue in subscriptions.values():
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            # Slow subscriber, drop the message for it
+            pass
 
 
 # FastAPI CRUDL endpoints
 
 @app.post("/processed_agent_data/")
-async def create_processed_agent_data(data: List[ProcessedAgentData]):
+async def create_processed_agent_data(data: List[ProcessedAgentData], db: Session = Depends(get_db)):
     # Insert data to database
     # Send data to subscribers
-    db = get_db()
     processed_agent_data_list = []
 
     for item in data:
@@ -144,7 +330,7 @@ async def create_processed_agent_data(data: List[ProcessedAgentData]):
                 COLUMN_Z: item.agent_data.accelerometer.z,
                 COLUMN_LATITUDE: item.agent_data.gps.latitude,
                 COLUMN_LONGITUDE: item.agent_data.gps.longitude,
-                COLUMN_TIMESTAMP: item.agent_data.timestamp
+                COLUMN_TIMESTAMP: to_db_timestamp(item.agent_data.timestamp)
             }
 
             processed_agent_data_list.append(new_processed_agent_data)
@@ -152,101 +338,117 @@ async def create_processed_agent_data(data: List[ProcessedAgentData]):
         except Exception:
             raise HTTPException(status_code=500, detail="Error")
 
-    insert_processed_agent_data = insert(processed_agent_data).values(processed_agent_data_list)
-
     try:
-        db.execute(insert_processed_agent_data)
-        db.commit()
+        # Blocking psycopg2 calls run on the threadpool, not on the event loop
+        await run_in_threadpool(store_processed_agent_data, db, processed_agent_data_list)
     except Exception:
         raise HTTPException(status_code=500, detail="Error")
-    finally:
-        db.close()
+
+    if subscriptions and processed_agent_data_list:
+        # Large uploads take a while to format, keep that off the event loop too
+        message = await run_in_threadpool(processed_agent_data_message, processed_agent_data_list)
+        broadcast(message)
+
+
+async def export_rows():
+    # Own session: the request dependencies are closed before the body is streamed
+    async with AsyncSessionLocal() as db:
+        select_processed_agent_data = (
+            select(processed_agent_data)
+            .order_by(processed_agent_data.c.id)
+            .execution_options(yield_per=EXPORT_BUFFER_SIZE))
+        result = await db.stream(select_processed_agent_data)
+        async for row in result:
+            yield orjson.dumps(dict(row._mapping)) + b"\n"
+
+
+@app.get("/processed_agent_data/export/")
+async def export_processed_agent_data():
+    # Stream all data as newline-delimited JSON
+    return StreamingResponse(export_rows(), media_type="application/x-ndjson")
 
 
 # Send data to subscribers
 @app.get("/processed_agent_data/{processed_agent_data_id}", response_model=ProcessedAgentDataInDB)
-def read_processed_agent_data(processed_agent_data_id: int):
+async def read_processed_agent_data(processed_agent_data_id: int, db: AsyncSession = Depends(get_async_db)):
     # Get data by id
-    db = get_db()
     try:
         select_processed_agent_data = select(processed_agent_data).where(
             processed_agent_data.c.id == processed_agent_data_id)
-        select_processed_agent_data_value = db.execute(select_processed_agent_data).fetchone()
+        select_processed_agent_data_value = (await db.execute(select_processed_agent_data)).fetchone()
         return select_processed_agent_data_value
     except Exception:
         raise HTTPException(status_code=500, detail="Error")
-    finally:
-        db.close()
 
 
 # Get data by id
 
 @app.get("/processed_agent_data/", response_model=list[ProcessedAgentDataInDB])
-def list_processed_agent_data():
-    # Get list of data
-    db = get_db()
+async def list_processed_agent_data(limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+                                    offset: int = Query(0, ge=0),
+                                    db: AsyncSession = Depends(get_async_db)):
+    # Get page of data
     try:
-        all_processed_agent_data = db.query(processed_agent_data).all()
+        select_processed_agent_data = (
+            select(processed_agent_data)
+            .order_by(processed_agent_data.c.id)
+            .limit(limit)
+            .offset(offset))
+        all_processed_agent_data = (await db.execute(select_processed_agent_data)).fetchall()
         return all_processed_agent_data
     except Exception:
         raise HTTPException(status_code=500, detail="Error")
-    finally:
-        db.close()
 
 
 # Get list of data
 
 @app.put("/processed_agent_data/{processed_agent_data_id}", response_model=ProcessedAgentDataInDB)
-def update_processed_agent_data(processed_agent_data_id: int, data: ProcessedAgentData):
-    # Update data
-    db = get_db()
+def update_processed_agent_data(processed_agent_data_id: int, data: dict = Body(...),
+                                db: Session = Depends(get_db)):
+    # Update data, only the fields present in the body are validated and changed
+    try:
+        values = get_update_values(data)
+    except ValueError:
+        # pydantic's ValidationError is a ValueError too
+        raise HTTPException(status_code=422, detail="Invalid data")
+    if not values:
+        raise HTTPException(status_code=400, detail="Nothing to update")
+
     try:
         update_processed_agent_data = (
             update(processed_agent_data)
             .where(processed_agent_data.c.id == processed_agent_data_id)
-            .values({
-                COLUMN_ROAD_STATE: data.road_state,
-                COLUMN_X: data.agent_data.accelerometer.x,
-                COLUMN_Y: data.agent_data.accelerometer.y,
-                COLUMN_Z: data.agent_data.accelerometer.z,
-                COLUMN_LATITUDE: data.agent_data.gps.latitude,
-                COLUMN_LONGITUDE: data.agent_data.gps.longitude,
-                COLUMN_TIMESTAMP: data.agent_data.timestamp
-            }))
-        db.execute(update_processed_agent_data)
+            .values(values)
+            .returning(*processed_agent_data.c))
+        data_value = db.execute(update_processed_agent_data).fetchone()
         db.commit()
-
-        select_processed_agent_data = select(processed_agent_data).where(processed_agent_data.c.id == processed_agent_data_id)
-        data_value = db.execute(select_processed_agent_data).fetchone()
         return data_value
     except Exception:
         raise HTTPException(status_code=500, detail="Error")
-    finally:
-        db.close()
 
 
 @app.delete("/processed_agent_data/{processed_agent_data_id}", response_model=ProcessedAgentDataInDB)
-def delete_processed_agent_data(processed_agent_data_id: int):
+def delete_processed_agent_data(processed_agent_data_id: int, db: Session = Depends(get_db)):
     # Delete by id
-    db = get_db()
     try:
-        select_processed_agent_data = db.execute(
-            select(processed_agent_data).where(processed_agent_data.c.id == processed_agent_data_id)).fetchone()
+        delete_data = (
+            delete(processed_agent_data)
+            .where(processed_agent_data.c.id == processed_agent_data_id)
+            .returning(*processed_agent_data.c))
+        deleted_processed_agent_data = db.execute(delete_data).fetchone()
 
-        if select_processed_agent_data is None:
+        if deleted_processed_agent_data is None:
             raise HTTPException(status_code=400, detail="Not found")
 
-        delete_data = delete(processed_agent_data).where(processed_agent_data.c.id == processed_agent_data_id)
-        db.execute(delete_data)
         db.commit()
-        return select_processed_agent_data
+        return deleted_processed_agent_data
     except Exception:
         raise HTTPException(status_code=500, detail="Error")
-    finally:
-        db.close()
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # Broadcast payloads are small; per-connection deflate would compress the
+    # same message once per subscriber
+    uvicorn.run(app, host="127.0.0.1", port=8000, ws_per_message_deflate=False)
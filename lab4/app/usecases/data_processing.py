@@ -1,6 +1,13 @@
+import numpy as np
+
 from app.entities.agent_data import AgentData
 from app.entities.processed_agent_data import ProcessedAgentData
 
+# Accelerometer y value above which the road surface is considered a pit
+THRESH = 15.0
+# Road state by label: 0 - straight, 1 - pit
+ROAD_STATES = np.array(["straight", "pit"])
+
 
 def process_agent_data(agent_data: AgentData) -> ProcessedAgentData:
     """
@@ -14,9 +21,23 @@ def process_agent_data(agent_data: AgentData) -> ProcessedAgentData:
             the road surface and agent data.
     """
 
-    # Implement it
+    # y is a Python float (float64), the same comparison as the batch path
+    road_state = "pit" if agent_data.accelerometer.y > THRESH else "straight"
+    return ProcessedAgentData(road_state=road_state, agent_data=agent_data)
+
+
+def process_agent_data_batch(ys: np.ndarray) -> np.ndarray:
+    """
+    Classify the state of the road surface for a batch of samples at once.
 
-    road_state = "straight"
-    if agent_data.accelerometer.y > 15:
-        road_state = "pit"
-    return ProcessedAgentData(road_state=road_state, agent_data=agent_data)
\ No newline at end of file
+    Parameters:
+        ys (np.ndarray): Accelerometer y values of the samples.
+
+    Returns:
+        road_states (np.ndarray): Road state of every sample, "pit" or "straight".
+    """
+    # float64 like the pydantic floats, so no sample is rounded across THRESH
+    ys = np.ascontiguousarray(ys, dtype=np.float64)
+    # Branchless: the comparison result is used as an index into ROAD_STATES
+    labels = (ys > THRESH).view(np.uint8)
+    return ROAD_STATES[labels]